@@ -4,33 +4,64 @@ API App Management
 
 # stdlib
 from datetime import date, datetime
+from functools import lru_cache
 
 # library
-from motor.motor_asyncio import AsyncIOMotorClient
+import orjson
 from quart.json import JSONEncoder
 from quart_openapi import Pint
 
 
+# Naive datetimes are UTC and rendered with a "Z" suffix
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+def _format_datetime(value: datetime) -> str:
+    if value.tzinfo is None:
+        return value.isoformat() + "Z"
+    return value.isoformat().replace("+00:00", "Z")
+
+
+# Checked by exact type first, then by isinstance for subclasses
+_DEFAULT_HANDLERS = {datetime: _format_datetime, date: date.isoformat}
+
+
+def dump_json(
+    object_, sort_keys: bool = False, indent: bool = False, default=None
+) -> bytes:
+    """Serialize an object to JSON bytes with orjson and the API's options"""
+    option = ORJSON_OPTIONS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(object_, default=default or JSON_DEFAULT, option=option)
+
+
 class CustomJSONEncoder(JSONEncoder):
-    """Customize the JSON date format"""
+    """Customize the JSON date format and serialize with orjson"""
+
+    def encode(self, o) -> str:
+        return dump_json(o, self.sort_keys, self.indent, self.default).decode()
 
     # pylint: disable=arguments-differ
     def default(self, object_):
-        try:
-            if isinstance(object_, datetime):
-                new_object_ = object_.replace(tzinfo=None)
-                return new_object_.isoformat() + "Z"
-            if isinstance(object_, date):
-                return object_.isoformat()
-            iterable = iter(object_)
-        except TypeError:
-            pass
-        else:
-            return list(iterable)
+        if (handler := _DEFAULT_HANDLERS.get(type(object_))) is not None:
+            return handler(object_)
+        if hasattr(object_, "__iter__"):
+            return list(object_)
+        for type_, handler in _DEFAULT_HANDLERS.items():
+            if isinstance(object_, type_):
+                return handler(object_)
         return JSONEncoder.default(self, object_)
 
 
+# Handles types orjson doesn't support natively
+JSON_DEFAULT = CustomJSONEncoder().default
+
+
 CORS_HEADERS = ["Authorization", "Content-Type"]
+_CORS_HEADERS_STR = ",".join(CORS_HEADERS)
 
 
 def add_cors(response):
@@ -38,26 +69,49 @@ def add_cors(response):
 
     Fixes CORS bug where headers are not included in OPTIONS
     """
-    for key, value in (
-        ("Access-Control-Allow-Origin", "*"),
-        ("Access-Control-Allow-Headers", CORS_HEADERS),
-        ("Access-Control-Allow-Methods", list(response.allow)),
-    ):
-        if key not in response.headers:
-            if isinstance(value, list):
-                value = ",".join(value)
-            response.headers.add(key, value)
+    headers = response.headers
+    if "Access-Control-Allow-Origin" not in headers:
+        headers["Access-Control-Allow-Origin"] = "*"
+    if "Access-Control-Allow-Headers" not in headers:
+        headers["Access-Control-Allow-Headers"] = _CORS_HEADERS_STR
+    if "Access-Control-Allow-Methods" not in headers:
+        headers["Access-Control-Allow-Methods"] = ",".join(response.allow)
     return response
 
 
-def create_app(name: str, mongo_uri: str = None) -> Pint:
-    """Create the core API app. Supply URIs as necessary"""
+def add_robots_tag(response):
+    """Ask crawlers not to index API responses"""
+    if "X-Robots-Tag" not in response.headers:
+        response.headers["X-Robots-Tag"] = "noindex"
+    return response
+
+
+# Keeps a warm set of connections for token and cache lookups while bounding bursts
+MONGO_POOL_OPTIONS = {"maxPoolSize": 100, "minPoolSize": 10, "maxIdleTimeMS": 300_000}
+
+
+@lru_cache(maxsize=None)
+def _motor_client() -> type:
+    """Imports the Motor client only when a Mongo URI is given"""
+    # pylint: disable=import-outside-toplevel
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    return AsyncIOMotorClient
+
+
+def create_app(name: str, mongo_uri: str = None, mongo_options: dict = None) -> Pint:
+    """Create the core API app. Supply URIs as necessary
+
+    mongo_options are passed to the Motor client and override the pool defaults
+    """
     app = Pint(name)
+    options = {**MONGO_POOL_OPTIONS, **(mongo_options or {})}
 
     @app.before_serving
     async def _startup():
-        app.mdb = AsyncIOMotorClient(mongo_uri) if mongo_uri else None
+        app.mdb = _motor_client()(mongo_uri, **options) if mongo_uri else None
 
     app.json_encoder = CustomJSONEncoder
     app.after_request(add_cors)
+    app.after_request(add_robots_tag)
     return app
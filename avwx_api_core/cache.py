@@ -2,9 +2,16 @@
 MongoDB document cache management
 """
 
+# pylint: disable=unidiomatic-typecheck,too-many-instance-attributes
+
 # stdlib
-from copy import copy
+import asyncio as aio
+import logging
+from collections import defaultdict
+from copy import deepcopy
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from types import MappingProxyType
 from typing import Any, Optional
 
 # library
@@ -15,56 +22,161 @@ from quart import Quart
 from avwx_api_core.util.handler import mongo_handler
 
 
+logger = logging.getLogger(__name__)
+
+
 # Table expiration in minutes
-EXPIRES = {"token": 15, "airsigmet": 15}
+EXPIRES = MappingProxyType({"token": 15, "airsigmet": 15})
 DEFAULT_EXPIRES = 2
 
+# Document flag set to 1 if '$' keys were escaped before storage, else 0
+ESCAPED_FLAG = "_dk"
+
+
+# Lowercase collection names by the table name given by callers
+_TABLE_NAMES: dict[str, str] = {}
+
+
+def _table_name(table: str) -> str:
+    """Returns the collection name for a table without lowering it every call"""
+    name = _TABLE_NAMES.get(table)
+    if name is None:
+        name = _TABLE_NAMES[table] = table.lower()
+    return name
+
+
+def _has_key(data: dict, key: str) -> bool:
+    """Returns True if any nested dict contains the key"""
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if type(item) is list:
+            stack.extend(i for i in item if type(i) in (dict, list))
+            continue
+        if key in item:
+            return True
+        stack.extend(v for v in item.values() if type(v) in (dict, list))
+    return False
 
-def _replace_keys(data: Optional[dict], key: str, by_key: str) -> Optional[dict]:
-    """Replaces recursively the keys equal to 'key' by 'by_key'
+
+def _replace_keys(data: Optional[dict], key: str, by_key: str) -> bool:
+    """Replaces in place the keys equal to 'key' by 'by_key' in all nested dicts
 
     Some keys in the report data are '$' and this is not accepted by MongoDB
+
+    Returns True if any key was replaced
     """
     if data is None:
-        return None
-    for d_key, d_val in list(data.items()):
-        if d_key == key:
-            data[by_key] = data.pop(key)
-        if isinstance(d_val, dict):
-            data[d_key] = _replace_keys(d_val, key, by_key)
+        return False
+    replaced = False
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if type(item) is list:
+            stack.extend(i for i in item if type(i) in (dict, list))
+            continue
+        if key in item:
+            item[by_key] = item.pop(key)
+            replaced = True
+        stack.extend(v for v in item.values() if type(v) in (dict, list))
+    return replaced
+
+
+def _process_data(data: dict, now: datetime = None) -> dict:
+    # The flag describes this write only. $set keeps top-level fields from
+    # earlier writes, which _restore_data checks for separately
+    now = now or datetime.now(tz=timezone.utc)
+    if not _has_key(data, "$"):
+        return {**data, ESCAPED_FLAG: 0, "timestamp": now}
+    # Nested dicts are replaced in place, so don't modify the caller's data
+    data = deepcopy(data)
+    _replace_keys(data, "$", "_$")
+    data[ESCAPED_FLAG] = 1
+    data["timestamp"] = now
     return data
 
 
-def _process_data(data: dict) -> dict:
-    data = _replace_keys(copy(data), "$", "_$")
-    data["timestamp"] = datetime.now(tz=timezone.utc)
+def _restore_data(data: Optional[dict]) -> Optional[dict]:
+    """Reverts escaped keys unless the document was flagged as clean on write"""
+    # Documents written before the flag existed have none and are always checked
+    # Top-level values are replaced whole, so only a top-level '_$' field can be
+    # left over from an earlier escaped write
+    if data and (data.pop(ESCAPED_FLAG, 1) or "_$" in data):
+        _replace_keys(data, "_$", "$")
     return data
 
 
 class CacheManager:
-    """Handles expiring updates to/from the document cache"""
+    """Handles expiring updates to/from the document cache
+
+    If flush_interval (seconds) is set, single updates are buffered and written
+    in one bulk write per table after the interval. Reads may lag behind
+    buffered writes by up to that interval
+
+    If fast_expire is set, get first fetches only the timestamp and skips
+    loading expired documents. Useful when most lookups are expired
+    """
 
     _app: Quart
+    _deltas: dict[str, timedelta]
+    _default_delta: timedelta
+    _collections: dict[str, Any]
+    _collections_mdb: Any
+    _pending: dict[str, dict[str, dict]]
+    _flush_handle: Optional[aio.TimerHandle]
+    _flush_tasks: set[aio.Task]
     expires: dict
+    fast_expire: bool
+    flush_interval: Optional[float]
 
-    def __init__(self, app: Quart, expires: dict = None):
+    def __init__(
+        self,
+        app: Quart,
+        expires: dict = None,
+        flush_interval: float = None,
+        fast_expire: bool = False,
+    ):
         self._app = app
-        self.expires = copy(EXPIRES)
-        if expires:
-            self.expires.update(expires)
+        self.expires = {**EXPIRES, **(expires or {})}
+        # Expiration lengths are fixed after init
+        self._deltas = {t: timedelta(minutes=m) for t, m in self.expires.items()}
+        self._default_delta = timedelta(minutes=DEFAULT_EXPIRES)
+        self._collections, self._collections_mdb = {}, None
+        self.fast_expire = fast_expire
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(dict)
+        self._flush_handle = None
+        self._flush_tasks = set()
+        if flush_interval:
+            self._app.after_serving(self.flush)
+
+    def _collection(self, table: str) -> Any:
+        """Returns the cache collection for a table, reusing the reference"""
+        mdb = self._app.mdb
+        if mdb is not self._collections_mdb:
+            self._collections, self._collections_mdb = {}, mdb
+        table = _table_name(table)
+        collection = self._collections.get(table)
+        if collection is None:
+            collection = self._collections[table] = mdb.cache[table]
+        return collection
 
-    def has_expired(self, time: datetime, table: str) -> bool:
-        """Returns True if a datetime is older than the number of minutes given"""
+    def has_expired(self, time: datetime, table: str, now: datetime = None) -> bool:
+        """Returns True if a datetime is older than the number of minutes given
+
+        Supply now when checking many items against the same time
+        """
         if not time:
             return True
         if time.tzinfo is None:
             time = time.replace(tzinfo=timezone.utc)
-        minutes = self.expires.get(table, DEFAULT_EXPIRES)
-        return datetime.now(tz=timezone.utc) > time + timedelta(minutes=minutes)
+        delta = self._deltas.get(table, self._default_delta)
+        now = now or datetime.now(tz=timezone.utc)
+        return now > time + delta
 
-    def _include_item(self, item: Any, table: str) -> bool:
+    def _include_item(self, item: Any, table: str, now: datetime = None) -> bool:
         return isinstance(item, dict) and not self.has_expired(
-            item.get("timestamp"), table
+            item.get("timestamp"), table, now
         )
 
     async def all(self, table: str, force: bool = False) -> list[dict]:
@@ -77,13 +189,14 @@ class CacheManager:
             return []
 
         async def search():
-            return [i async for i in self._app.mdb.cache[table.lower()].find()]
+            return [i async for i in self._collection(table).find()]
 
-        data = await mongo_handler(search())
-        data = [_replace_keys(i, "_$", "$") for i in data]
+        data = await mongo_handler(search)
+        data = [_restore_data(i) for i in data]
         if force:
             return data
-        return [i for i in data if self._include_item(i, table)]
+        now = datetime.now(tz=timezone.utc)
+        return [i for i in data if self._include_item(i, table, now)]
 
     async def get(self, table: str, key: str, force: bool = False) -> Optional[dict]:
         """Returns the current cached data for a report type and station
@@ -93,9 +206,15 @@ class CacheManager:
         """
         if self._app.mdb is None:
             return
-        search = self._app.mdb.cache[table.lower()].find_one({"_id": key})
-        data = await mongo_handler(search)
-        data = _replace_keys(data, "_$", "$")
+        collection = self._collection(table)
+        if self.fast_expire and not force:
+            projection = {"_id": 0, "timestamp": 1}
+            search = partial(collection.find_one, {"_id": key}, projection)
+            stamp = await mongo_handler(search)
+            if not stamp or self.has_expired(stamp.get("timestamp"), table):
+                return
+        data = await mongo_handler(lambda: collection.find_one({"_id": key}))
+        data = _restore_data(data)
         if force:
             return data
         if self._include_item(data, table):
@@ -106,18 +225,75 @@ class CacheManager:
         """Update the cache"""
         if self._app.mdb is None:
             return
-        update = self._app.mdb.cache[table.lower()].update_one(
-            {"_id": key}, {"$set": _process_data(data)}, upsert=True
+        if self.flush_interval:
+            self._buffer_update(_table_name(table), key, _process_data(data))
+            return
+        update = partial(
+            self._collection(table).update_one,
+            {"_id": key},
+            {"$set": _process_data(data)},
+            upsert=True,
         )
         await mongo_handler(update)
 
+    def _buffer_update(self, table: str, key: str, data: dict) -> None:
+        """Add an update to the pending writes and schedule a flush"""
+        pending = self._pending[table]
+        # Matches the $set semantics of sequential updates to the same key
+        if key in pending:
+            pending[key].update(data)
+        else:
+            pending[key] = data
+        if self._flush_handle is None:
+            self._flush_handle = aio.get_running_loop().call_later(
+                self.flush_interval, self._start_flush
+            )
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        task = aio.create_task(self._write_pending())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: aio.Task) -> None:
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            logger.error("Failed to flush cache updates", exc_info=exc)
+
+    async def flush(self) -> None:
+        """Write all buffered updates to the cache
+
+        Also waits for flushes already started by the timer
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        await self._write_pending()
+        await aio.gather(*self._flush_tasks, return_exceptions=True)
+
+    async def _write_pending(self) -> None:
+        """Write the updates buffered so far in one bulk write per table"""
+        pending, self._pending = self._pending, defaultdict(dict)
+        if self._app.mdb is None or not pending:
+            return
+        writes = []
+        for table, items in pending.items():
+            updates = [
+                UpdateOne({"_id": k}, {"$set": d}, upsert=True)
+                for k, d in items.items()
+            ]
+            write = partial(self._collection(table).bulk_write, updates, ordered=False)
+            writes.append(mongo_handler(write))
+        await aio.gather(*writes)
+
     async def update_many(self, table: str, keys: list[str], data: list[dict]) -> None:
         """Update many items in the cache"""
         if self._app.mdb is None:
             return
+        now = datetime.now(tz=timezone.utc)
         updates = [
-            UpdateOne({"_id": k}, {"$set": _process_data(d)}, upsert=True)
+            UpdateOne({"_id": k}, {"$set": _process_data(d, now)}, upsert=True)
             for k, d in zip(keys, data)
         ]
-        update = self._app.mdb.cache[table.lower()].bulk_write(updates, ordered=False)
+        update = partial(self._collection(table).bulk_write, updates, ordered=False)
         await mongo_handler(update)
@@ -3,8 +3,8 @@ Local counter to aggregate calls to databases
 """
 
 # stdlib
+import logging
 import time
-import asyncio as aio
 
 # library
 from quart import Quart
@@ -13,15 +13,23 @@ from quart import Quart
 from avwx_api_core.util.queue import Queue
 
 
+logger = logging.getLogger(__name__)
+
+
 class DelayedCounter:
-    """Manages counts to limit calls to database"""
+    """Manages counts to limit calls to database
+
+    Subclasses handle queued values in _process_batch. Subclasses that instead
+    override _worker without a shard argument take values one at a time with
+    self._queue.get()
+    """
 
     _app: Quart
     _data: dict
     _queue: Queue
     update_at: int
     interval: int  # seconds
-    locked: bool = False
+    batch_limit: int = 500
 
     def __init__(self, app: Quart, interval: int = 60):
         self._app = app
@@ -32,22 +40,31 @@ class DelayedCounter:
         self._app.after_serving(self.clean)
 
     async def _pre_add(self):
-        """Checks if the counts should be flushed and waits for lock"""
+        """Checks if the counts should be flushed"""
         if time.time() > self.update_at:
             self.update()
-        while self.locked:
-            await aio.sleep(0.000001)
 
-    async def _worker(self):
-        """Task worker main"""
+    async def _worker(self, shard: int):
+        """Task worker main for one queue shard"""
+        while True:
+            async with self._queue.get_batch(shard, self.batch_limit) as values:
+                # Keys stay on one shard, so the worker must outlive a bad batch
+                try:
+                    await self._process_batch(values)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Failed to process %d queued values", len(values))
+
+    async def _process_batch(self, values: list):
+        """Handle all values taken from the queue at once"""
         raise NotImplementedError()
 
     def gather_data(self) -> dict:
-        """Returns existing data while locking to prevent missed values"""
-        self.locked = True
+        """Returns existing data and starts a new collection
+
+        Runs without awaiting, so no add can interleave with the swap
+        """
         to_update = self._data
         self._data = {}
-        self.locked = False
         return to_update
 
     def update(self):
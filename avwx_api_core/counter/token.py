@@ -2,11 +2,15 @@
 Manages authentication tokens storage and counting
 """
 
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+
 # stdlib
 import time
 import asyncio as aio
-from contextlib import suppress
+import heapq
+import logging
 from datetime import datetime, timezone
+from functools import lru_cache, partial
 from typing import Optional
 
 # library
@@ -19,83 +23,236 @@ from avwx_api_core.counter.base import DelayedCounter
 from avwx_api_core.util.handler import mongo_handler
 
 
+logger = logging.getLogger(__name__)
+
 DEV_TOKEN_LIMIT = 4000
 
 
+@lru_cache(maxsize=1)
+def _day_key(day: int) -> datetime:
+    """Returns the UTC midnight datetime for a count of days since the epoch"""
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc)
+
+
+class _Entry:
+    """Cached token data and its counts for the current interval
+
+    plan is shared by all of a user's tokens of the same kind. usage is the key
+    of the shared user total the token counts against
+    """
+
+    __slots__ = ("token", "plan", "count", "overage", "id", "usage", "_data")
+
+    def __init__(
+        self, token: dict, plan: dict, id_: ObjectId, usage: tuple[ObjectId, bool]
+    ):
+        self.token = token
+        self.plan = plan
+        self.count = 0
+        self.overage = 0
+        self.id = id_
+        self.usage = usage
+        self._data = None
+
+    @property
+    def data(self) -> dict:
+        """Token and plan fields, built only for tokens that are requested"""
+        if self._data is None:
+            self._data = {**self.token, **self.plan}
+        return self._data
+
+
 class TokenCountCache(DelayedCounter):
-    """Caches and counts user auth tokens"""
+    """Caches and counts user auth tokens
+
+    Relies on indexes for account.user (tokens.value) and account.token
+    (user_id, date, token_id) which are created in the background on startup
+
+    Lookups for uncached tokens in the same loop iteration are combined into
+    one query of up to fetch_limit tokens
+
+    After each update, up to prefetch_limit of the most used tokens are fetched
+    in the background once the queued counts are written, so their next request
+    doesn't wait on the database
+    """
+
+    _fetching: dict[str, aio.Event]
+    _date: datetime
+    _pending: dict[str, aio.Future]
+    _fetch_handle: Optional[aio.Handle]
+    _fetch_tasks: set[aio.Task]
+    _prefetch_tasks: set[aio.Task]
+    _closing: bool
+    _index_task: Optional[aio.Task]
+    fetch_limit: int = 100
+    prefetch_limit: int = 100
 
     def __init__(self, app: Quart, interval: int = 60):
         super().__init__(app, interval)
         self._user = {}
+        self._fetching = {}
+        self._pending = {}
+        self._fetch_handle = None
+        self._fetch_tasks = set()
+        self._date = self.date_key()
+        self._prefetch_tasks = set()
+        self._closing = False
+        self._index_task = None
+        self._app.before_serving(self._start_ensure_indexes)
+
+    async def _start_ensure_indexes(self):
+        """Create indexes in the background so startup never waits on the database"""
+        self._index_task = aio.create_task(self.ensure_indexes())
+
+    async def ensure_indexes(self):
+        """Create the indexes used by token lookups and counter updates
+
+        Failures are logged. Lookups still work without the indexes, only slower
+        """
+        if self._app.mdb is None:
+            return
+        account = self._app.mdb.account
+        try:
+            await aio.gather(
+                account.user.create_index("tokens.value"),
+                account.token.create_index(
+                    [("user_id", 1), ("date", 1), ("token_id", 1)]
+                ),
+            )
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Failed to create token indexes")
 
     @staticmethod
     def date_key() -> datetime:
         """Returns the current date as a sub POSIX key"""
-        return datetime.now(tz=timezone.utc).replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
+        return _day_key(int(time.time()) // 86400)
 
-    async def _fetch_token_data(self, token: str) -> Optional[dict]:
-        """Fetch token data from database"""
-        if self._app.mdb is None:
-            return None
-        search = self._app.mdb.account.user.find_one(
-            {"tokens.value": token},
+    def _token_data_pipeline(self, tokens: list[str]) -> list[dict]:
+        """Aggregation returning the plan, tokens, and today's usage per token
+        of each user owning one of the tokens
+        """
+        usage = {
+            "$and": [
+                {"$eq": ["$user_id", "$$user"]},
+                {"$eq": ["$date", self._date]},
+                {"$in": ["$token_id", "$$tokens"]},
+            ]
+        }
+        return [
+            {"$match": {"tokens.value": {"$in": tokens}}},
+            {
+                "$project": {
+                    "tokens._id": 1,
+                    "tokens.value": 1,
+                    "tokens.active": 1,
+                    "plan.limit": 1,
+                    "plan.name": 1,
+                    "plan.type": 1,
+                    "allow_overage": 1,
+                    "addons.key": 1,
+                }
+            },
             {
-                "tokens._id": 1,
-                "tokens.value": 1,
-                "tokens.active": 1,
-                "plan.limit": 1,
-                "plan.name": 1,
-                "plan.type": 1,
-                "allow_overage": 1,
-                "addons.key": 1,
+                "$lookup": {
+                    "from": "token",
+                    "let": {"user": "$_id", "tokens": "$tokens._id"},
+                    "pipeline": [
+                        {"$match": {"$expr": usage}},
+                        {"$group": {"_id": "$token_id", "total": {"$sum": "$count"}}},
+                    ],
+                    "as": "usage",
+                }
             },
-        )
-        data = await mongo_handler(search)
-        if not data:
+        ]
+
+    @staticmethod
+    def _token_data(token: str, user: Optional[dict]) -> Optional[dict]:
+        """Returns the plan and usage of a user's tokens of the same kind"""
+        if not user:
             return None
         is_dev = token.startswith("dev-")
-        tokens = [t for t in data["tokens"] if is_dev == t["value"].startswith("dev-")]
-        addons = [addon["key"] for addon in data.get("addons", tuple())]
+        tokens = [
+            {"_id": item["_id"], "value": item["value"], "active": item["active"]}
+            for item in user["tokens"]
+            if item["value"].startswith("dev-") == is_dev
+        ]
+        token_ids = {item["_id"] for item in tokens}
+        usage = sum(i["total"] for i in user.get("usage", ()) if i["_id"] in token_ids)
+        addons = [addon["key"] for addon in user.get("addons", tuple())]
         ret = {
-            "user": data["_id"],
+            "user": user["_id"],
             "tokens": tokens,
+            "usage": usage,
             "addons": addons,
-            "overage": data.get("allow_overage") or "overage" in addons,
-            **data["plan"],
+            "overage": user.get("allow_overage") or "overage" in addons,
+            **user["plan"],
         }
         if is_dev:
             ret["limit"] = DEV_TOKEN_LIMIT
         return ret
 
-    async def _fetch_token_usage(self, user: ObjectId) -> dict[ObjectId, int]:
-        """Fetch current token usage from counting table"""
+    async def _fetch_token_data(self, token: str) -> Optional[dict]:
+        """Fetch token data and the user's current usage from database
+
+        Lookups made in the same loop iteration are sent as a single query
+        """
         if self._app.mdb is None:
+            return None
+        future = self._pending.get(token)
+        if future is None:
+            loop = aio.get_running_loop()
+            future = self._pending[token] = loop.create_future()
+            if self._fetch_handle is None:
+                self._fetch_handle = loop.call_soon(self._start_fetch)
+        return await future
+
+    def _start_fetch(self):
+        """Send pending token lookups in batches of at most fetch_limit"""
+        self._fetch_handle = None
+        pending, self._pending = self._pending, {}
+        tokens = list(pending)
+        for i in range(0, len(tokens), self.fetch_limit):
+            batch = {
+                token: pending[token] for token in tokens[i : i + self.fetch_limit]
+            }
+            task = aio.create_task(self._fetch_batch(batch))
+            self._fetch_tasks.add(task)
+            task.add_done_callback(self._fetch_tasks.discard)
+
+    async def _fetch_batch(self, pending: dict[str, aio.Future]):
+        """Fetch the users owning the pending tokens and resolve each lookup"""
+        pipeline = self._token_data_pipeline(list(pending))
+
+        def search():
+            return self._app.mdb.account.user.aggregate(pipeline).to_list(None)
+
+        try:
+            users = await mongo_handler(search) or []
+        except Exception as exc:  # pylint: disable=broad-except
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(exc)
             return
-        key = self.date_key()
-        search = self._app.mdb.account.token.find(
-            {"user_id": user, "date": key}, {"_id": 0, "token_id": 1, "count": 1}
-        )
-        return {t["token_id"]: t["count"] async for t in search}
-
-    async def _set_usage(self, user_id: ObjectId, tokens: list[dict]):
-        """Set the user's existing token count"""
-        counts = await self._fetch_token_usage(user_id)
-        total = 0
-        for token in tokens:
-            total += counts.get(token["_id"], 0)
-        self._user[user_id] = total
-
-    def _set_tokens(self, data: list[dict]):
-        """Set token data in the counter"""
+        owners = {item["value"]: user for user in users for item in user["tokens"]}
+        for token, future in pending.items():
+            if future.done():
+                continue
+            # A malformed user only fails the lookups for its own tokens
+            try:
+                future.set_result(self._token_data(token, owners.get(token)))
+            except Exception as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+
+    def _set_tokens(self, data: dict, usage: tuple[ObjectId, bool]):
+        """Set token data in the counter. The remaining data is the shared plan"""
         tokens = data.pop("tokens")
         for item in tokens:
             key = item["value"]
+            # Don't reset counts for tokens already loaded this interval
+            if key in self._data:
+                continue
             token_id = item.pop("_id")
-            item.update(data)
-            self._data[key] = {"data": item, "count": 0, "overage": 0, "id": token_id}
+            self._data[key] = _Entry(item, data, token_id, usage)
 
     @staticmethod
     def _update_counts(match: dict, count: int, overage: int) -> UpdateOne:
@@ -106,36 +263,41 @@ class TokenCountCache(DelayedCounter):
         return UpdateOne(match, counts, upsert=True)
 
     @staticmethod
-    def _update_timestamps(match: dict, overage: int) -> list[UpdateOne]:
+    def _update_timestamps(match: dict, overage: int, now: datetime) -> list[UpdateOne]:
         """Create timestamp usage operations"""
-        now = datetime.now(tz=timezone.utc)
         updates = [UpdateOne(match, {"$set": {"updated": now}}, upsert=True)]
         if overage:
             excluding = {**match, "overage_started": {"$exists": False}}
             updates.append(UpdateOne(excluding, {"$set": {"overage_started": now}}))
         return updates
 
-    async def _process_queue_value(self, value: tuple[ObjectId, str, int, int]):
-        """Updates token counts and timestamps from queued value"""
-        user, token, count, overage = value
-        match = {"user_id": user, "token_id": token, "date": self.date_key()}
-        updates = [self._update_counts(match, count, overage)]
-        updates += self._update_timestamps(match, overage)
-        await mongo_handler(self._app.mdb.account.token.bulk_write(updates))
-
-    async def _worker(self):
-        """Task worker main"""
-        while True:
-            async with self._queue.get() as value:
-                if self._app.mdb:
-                    await self._process_queue_value(value)
+    async def _process_batch(
+        self, values: list[tuple[ObjectId, str, datetime, int, int]]
+    ):
+        """Updates token counts and timestamps from queued values in one write"""
+        if not self._app.mdb:
+            return
+        # Sum values for the same token and day so each gets one set of operations
+        totals: dict[tuple[ObjectId, str, datetime], list[int]] = {}
+        for user, token, key, count, overage in values:
+            if (total := totals.get((user, token, key))) is None:
+                totals[(user, token, key)] = [count, overage]
+            else:
+                total[0] += count
+                total[1] += overage
+        now = datetime.now(tz=timezone.utc)
+        updates = []
+        for (user, token, key), (count, overage) in totals.items():
+            match = {"user_id": user, "token_id": token, "date": key}
+            updates.append(self._update_counts(match, count, overage))
+            updates += self._update_timestamps(match, overage, now)
+        write = partial(self._app.mdb.account.token.bulk_write, updates)
+        await mongo_handler(write)
 
     def gather_data(self) -> dict:
-        """Returns existing data while locking to prevent missed values"""
-        self.locked = True
+        """Returns existing data and resets user totals for the next interval"""
         data = self._data
         self._data, self._user = {}, {}
-        self.locked = False
         return data
 
     def update(self):
@@ -145,33 +307,100 @@ class TokenCountCache(DelayedCounter):
         This means that the cutoff time is at most 2 * self.interval
         """
         to_update = self.gather_data()
+        # Counts belong to the day they were gathered, not the day they're written
+        # The day also rolls over for usage lookups here, once per interval
+        key = self._date = self.date_key()
         for item in to_update.values():
-            if not item:
-                continue
-            count = item["count"]
-            if not count:
-                continue
-            self._queue.add((item["data"]["user"], item["id"], count, item["overage"]))
+            if item and item.count:
+                self._queue_counts(item, key)
         self.update_at = time.time() + self.interval
+        self._start_prefetch(to_update)
+
+    def _queue_counts(self, item: _Entry, key: datetime):
+        """Send an entry's counts to the worker queue"""
+        user = item.plan["user"]
+        # Keep a user's counts on one worker so its batches can merge them
+        self._queue.add((user, item.id, key, item.count, item.overage), user)
+
+    def invalidate(self, token: str):
+        """Drop the cached data of a token and its user's other tokens so the
+        next request for each fetches it again
+
+        The plan is shared by all of a user's tokens, so none keep a stale copy.
+        Counts made so far are still written. The user's totals are kept
+        """
+        item = self._data.get(token)
+        if item is None:
+            return
+        user = item.plan["user"]
+        key = self.date_key()
+        for value in [k for k, i in self._data.items() if i.plan["user"] == user]:
+            item = self._data.pop(value)
+            if item.count:
+                self._queue_counts(item, key)
+
+    def _start_prefetch(self, data: dict):
+        """Schedule a background fetch of the most used tokens from the last interval"""
+        if self._closing or not self.prefetch_limit or self._app.mdb is None:
+            return
+        active = [(i.count, key) for key, i in data.items() if i and i.count]
+        tokens = [key for count, key in heapq.nlargest(self.prefetch_limit, active)]
+        if not tokens:
+            return
+        task = aio.create_task(self._prefetch(tokens))
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, tokens: list[str]):
+        """Load token data and usage ahead of the next request"""
+        # Fetched totals must include the counts this update just queued
+        await self._queue.join()
+        # A failed prefetch only means the request fetches the token itself
+        await aio.gather(*(self.get(token) for token in tokens), return_exceptions=True)
+
+    async def clean(self):
+        """Finish processing without starting new prefetches
+
+        Prefetches are cancelled. Lookups already sent are awaited so waiting
+        requests get their results
+        """
+        self._closing = True
+        if self._index_task is not None:
+            self._index_task.cancel()
+        for task in self._prefetch_tasks:
+            task.cancel()
+        if self._fetch_handle is not None:
+            self._fetch_handle.cancel()
+            self._start_fetch()
+        tasks = (*self._prefetch_tasks, *self._fetch_tasks)
+        await aio.gather(*tasks, return_exceptions=True)
+        await super().clean()
 
     async def get(self, token: str) -> Optional[dict]:
         """Fetch data for a token. Must be called before increment"""
         await self._pre_add()
+        item = self._data.get(token)
+        # Wait for busy thread to add data if not finished fetching
+        while item is None and token in self._fetching:
+            await self._fetching[token].wait()
+            item = self._data.get(token)
+        if item is not None:
+            return item.data
+        # Register the fetch so concurrent requests wait on its result
+        fetching = self._fetching[token] = aio.Event()
         try:
-            # Wait for busy thread to add data if not finished fetching
-            while self._data[token] is None:
-                await aio.sleep(0.0001)
-        except KeyError:
-            # Set None to indicate data fetch in progress
-            self._data[token] = None
             data = await self._fetch_token_data(token)
             if not data:
-                with suppress(KeyError):
-                    del self._data[token]
                 return None
-            await self._set_usage(data["user"], data["tokens"])
-            self._set_tokens(data)
-        return self._data[token]["data"]
+            # Dev and regular tokens have separate totals and limits
+            usage = (data["user"], token.startswith("dev-"))
+            # The total is kept current by add until the next gather clears it
+            self._user.setdefault(usage, data.pop("usage"))
+            self._set_tokens(data, usage)
+        finally:
+            del self._fetching[token]
+            fetching.set()
+        return self._data[token].data
 
     # pylint: disable=arguments-differ
     async def add(self, token: str) -> bool:
@@ -180,18 +409,17 @@ class TokenCountCache(DelayedCounter):
         Returns False if token has hit its limit or not found
         """
         try:
-            self._data[token]["count"] += 1
             item = self._data[token]
-            data = item["data"]
-            limit = data["limit"]
-            if limit is None:
-                return True
-            total, current = self._user[data["user"]], item["count"]
-            if limit >= total + current:
-                return True
-            if data.get("overage"):
-                self._data[token]["overage"] += 1
-                return True
-            return False
+            item.count += 1
+            plan = item.plan
+            # User total includes the counts of all of their tokens of this kind
+            self._user[item.usage] = total = self._user[item.usage] + 1
         except KeyError:
             return False
+        limit = plan["limit"]
+        if limit is None or limit >= total:
+            return True
+        if plan.get("overage"):
+            item.overage += 1
+            return True
+        return False
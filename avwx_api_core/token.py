@@ -15,7 +15,7 @@ from quart import Quart
 from avwx_api_core.counter.token import TokenCountCache
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     """Client auth token"""
 
@@ -30,7 +30,7 @@ class Token:
     name: str
     type: str
 
-    addons: list[str] = field(default_factory=[])
+    addons: list[str] = field(default_factory=list)
     overage: bool = False
 
     @property
@@ -52,24 +52,30 @@ class TokenManager:
     """Handles token fetch and counting"""
 
     _app: Quart
-    _counter = TokenCountCache
+    _counter: TokenCountCache
     active: bool
 
     def __init__(self, app: Quart):
         self._app = app
+        # Dev tokens share the cache but are limited and totaled separately
         self._counter = TokenCountCache(app)
-        self._dev = TokenCountCache(app)
         self.active = app.mdb is not None
 
     async def get(self, value: str) -> Token:
         """Get a token object by raw value"""
-        counter = self._dev if value.startswith("dev-") else self._counter
-        data = await counter.get(value)
+        data = await self._counter.get(value)
         return Token(**data) if data else None
 
     async def increment(self, token: str | Token) -> bool:
         """Increment a token count by Token object or raw value"""
         if isinstance(token, Token):
             token = token.value
-        counter = self._dev if token.startswith("dev-") else self._counter
-        return await counter.add(token)
+        return await self._counter.add(token)
+
+    def invalidate(self, token: str | Token):
+        """Remove a cached token and its user's other tokens, like after it is
+        revoked or the user's plan changes
+        """
+        if isinstance(token, Token):
+            token = token.value
+        self._counter.invalidate(token)
@@ -0,0 +1,134 @@
+"""
+Converts response data to XML
+
+Output matches dicttoxml with type attributes and "item" list elements
+"""
+
+# pylint: disable=unidiomatic-typecheck
+
+# stdlib
+from collections.abc import Iterable
+from functools import lru_cache
+from numbers import Number
+from typing import Any, Optional
+from xml.dom.minidom import parseString
+
+
+_ESCAPES = str.maketrans(
+    {"&": "&amp;", '"': "&quot;", "'": "&apos;", "<": "&lt;", ">": "&gt;"}
+)
+
+# Type attribute value by exact type. Other types are checked in _xml_type
+_XML_TYPES = {
+    type(None): "null",
+    bool: "bool",
+    str: "str",
+    int: "int",
+    float: "float",
+}
+
+
+def _escape(value: Any) -> str:
+    return value.translate(_ESCAPES) if type(value) is str else str(value)
+
+
+def _xml_type(value: Any) -> str:
+    if (name := _XML_TYPES.get(type(value))) is not None:
+        return name
+    if isinstance(value, Number):
+        return "number"
+    if isinstance(value, dict):
+        return "dict"
+    if isinstance(value, Iterable):
+        return "list"
+    return type(value).__name__
+
+
+def _is_valid_name(key: str) -> bool:
+    try:
+        parseString(f"<{key}>foo</{key}>")
+        return True
+    except Exception:  # pylint: disable=broad-except
+        return False
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _element_name(key: Any) -> tuple[str, Optional[str]]:
+    """Returns a valid element name for a key and the original name if replaced"""
+    key = _escape(key) if type(key) is str else key
+    if _is_valid_name(key):
+        return str(key), None
+    if str(key).isdigit():
+        return f"n{key}", None
+    try:
+        return f"n{float(str(key))}", None
+    except ValueError:
+        pass
+    if _is_valid_name(key.replace(" ", "_")):
+        return key.replace(" ", "_"), None
+    return "key", key
+
+
+def _open_tag(name: str, xml_type: str, original: Optional[str] = None) -> str:
+    if original is None:
+        return f'<{name} type="{xml_type}">'
+    return f'<{name} name="{original}" type="{xml_type}">'
+
+
+def _add_dict(out: list[str], data: dict):
+    for key, val in data.items():
+        name, original = _element_name(key)
+        if type(val) is bool:
+            out += (_open_tag(name, "bool", original), str(val).lower())
+        elif isinstance(val, Number) or type(val) is str:
+            out += (_open_tag(name, _xml_type(val), original), _escape(val))
+        elif hasattr(val, "isoformat"):
+            out += (_open_tag(name, "str", original), _escape(val.isoformat()))
+        elif isinstance(val, dict):
+            out.append(_open_tag(name, _xml_type(val), original))
+            _add_dict(out, val)
+        elif isinstance(val, Iterable):
+            out.append(_open_tag(name, "list", original))
+            _add_list(out, val)
+        elif val is None:
+            out.append(_open_tag(name, "null", original))
+        else:
+            raise TypeError(f"Unsupported data type: {val} ({type(val).__name__})")
+        out.append(f"</{name}>")
+
+
+def _add_list(out: list[str], items: Iterable):
+    for item in items:
+        # Booleans are numbers here, so list items keep Python's "True"
+        if isinstance(item, Number) or type(item) is str:
+            out += ('<item type="', _xml_type(item), '">', _escape(item))
+        elif hasattr(item, "isoformat"):
+            out += ('<item type="str">', _escape(item.isoformat()))
+        elif isinstance(item, dict):
+            out.append('<item type="dict">')
+            _add_dict(out, item)
+        elif isinstance(item, Iterable):
+            out.append('<item type="list">')
+            _add_list(out, item)
+        elif item is None:
+            out.append('<item type="null">')
+        else:
+            raise TypeError(f"Unsupported data type: {item} ({type(item).__name__})")
+        out.append("</item>")
+
+
+def to_xml(data: Any, root: str = "root") -> bytes:
+    """Returns data as a UTF-8 XML document under a root element"""
+    out = ['<?xml version="1.0" encoding="UTF-8" ?>', f"<{root}>"]
+    if type(data) is bool:
+        out += ('<item type="bool">', str(data).lower(), "</item>")
+    elif isinstance(data, dict):
+        _add_dict(out, data)
+    elif data is None or isinstance(data, (Number, str)) or hasattr(data, "isoformat"):
+        _add_list(out, (data,))
+    elif isinstance(data, Iterable):
+        _add_list(out, data)
+    else:
+        raise TypeError(f"Unsupported data type: {data} ({type(data).__name__})")
+    out.append(f"</{root}>")
+    return "".join(out).encode("utf-8")
@@ -4,19 +4,37 @@ Remote call handlers
 
 # stdlib
 import asyncio as aio
-from typing import Coroutine
+import inspect
+import logging
+import random
+from typing import Awaitable, Callable
 
 # library
 from pymongo.errors import AutoReconnect, OperationFailure
 
 
-async def mongo_handler(operation: Coroutine) -> object:
-    """Error handling around the Mongo client connection"""
-    for _ in range(5):
+logger = logging.getLogger(__name__)
+
+
+async def mongo_handler(operation: Callable[[], Awaitable] | Awaitable) -> object:
+    """Error handling around the Mongo client connection
+
+    If operation is a callable, it is called for each attempt, so reconnects are
+    retried with a new call after a jittered exponential backoff. An awaitable
+    can only be awaited once and is not retried
+    """
+    if inspect.isawaitable(operation):
+        try:
+            return await operation
+        except (AutoReconnect, OperationFailure) as exc:
+            logger.debug("Mongo operation failed: %s", exc)
+            return None
+    for i in range(5):
         try:
-            resp = await operation
+            resp = await operation()
             return resp
-        except OperationFailure:
+        except OperationFailure as exc:
+            logger.debug("Mongo operation failed: %s", exc)
             return
         except AutoReconnect:
-            await aio.sleep(0.5)
+            await aio.sleep(min(2.0, 0.1 * 2**i * (0.5 + random.random())))
@@ -4,36 +4,90 @@ Task queue management
 
 # stdlib
 import asyncio as aio
-from contextlib import asynccontextmanager
-from typing import Any, Coroutine
+import inspect
+from contextlib import asynccontextmanager, suppress
+from itertools import cycle
+from typing import Any, Coroutine, Hashable
 
 
 class Queue:
-    """Asynchronous task queue manager"""
+    """Asynchronous task queue manager
 
-    _queue: aio.Queue
+    Each worker drains its own queue shard if its _worker takes a shard index.
+    Values added with the same key always go to the same shard
+
+    Workers without a shard argument are called as _worker() and use get()
+    to take values from any shard
+    """
+
+    _queues: list[aio.Queue]
+    _shards: cycle
+    _added: aio.Event
     _workers: list[Coroutine]
 
     def __init__(self, worker_obj: object, count: int = 3):
-        self._queue = aio.Queue()
-        self._workers = [aio.create_task(worker_obj._worker()) for _ in range(count)]
+        self._queues = [aio.Queue() for _ in range(count)]
+        self._shards = cycle(range(count))
+        self._added = aio.Event()
+        worker = worker_obj._worker
+        if inspect.signature(worker).parameters:
+            self._workers = [aio.create_task(worker(i)) for i in range(count)]
+        else:
+            self._workers = [aio.create_task(worker()) for _ in range(count)]
 
-    def add(self, value: Any):
-        """Add a value to the queue"""
-        self._queue.put_nowait(value)
+    def add(self, value: Any, key: Hashable = None):
+        """Add a value to the queue. Values without a key are spread evenly"""
+        shard = next(self._shards) if key is None else hash(key) % len(self._queues)
+        self._queues[shard].put_nowait(value)
+        self._added.set()
+
+    async def _get_any(self) -> tuple[aio.Queue, Any]:
+        """Take the next value from whichever shard has one"""
+        while True:
+            for queue in self._queues:
+                with suppress(aio.QueueEmpty):
+                    return queue, queue.get_nowait()
+            self._added.clear()
+            await self._added.wait()
 
     @asynccontextmanager
-    async def get(self) -> Any:
-        """Get a value to handle. Used in a 'with' statement"""
-        value = await self._queue.get()
-        yield value
-        self._queue.task_done()
+    async def get(self, shard: int = None) -> Any:
+        """Get a value to handle. Used in a 'with' statement
+
+        Takes from any shard unless one is given
+        """
+        if shard is None:
+            queue, value = await self._get_any()
+        else:
+            queue = self._queues[shard]
+            value = await queue.get()
+        try:
+            yield value
+        finally:
+            queue.task_done()
+
+    @asynccontextmanager
+    async def get_batch(self, shard: int = 0, limit: int = None) -> list[Any]:
+        """Get up to limit values already queued. Used in a 'with' statement"""
+        queue = self._queues[shard]
+        values = [await queue.get()]
+        with suppress(aio.QueueEmpty):
+            while limit is None or len(values) < limit:
+                values.append(queue.get_nowait())
+        try:
+            yield values
+        finally:
+            for _ in values:
+                queue.task_done()
+
+    async def join(self):
+        """Wait until every value added so far has been handled"""
+        await aio.gather(*(queue.join() for queue in self._queues))
 
     async def clean(self, wait: bool = True):
         """Clean the queue and wait until all workers are finished"""
         if wait:
-            while not self._queue.empty():
-                await aio.sleep(0.01)
+            await self.join()
         for worker_thread in self._workers:
             worker_thread.cancel()
         await aio.gather(*self._workers, return_exceptions=True)
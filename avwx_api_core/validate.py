@@ -6,10 +6,12 @@ Entity schema validation
 
 # stdlib
 import re
-from typing import Callable
+from functools import cache
+from string import ascii_letters, digits
+from typing import Any, Callable, Optional
 
 # library
-from voluptuous import All, Coerce, Invalid, Length, Range
+from voluptuous import All, Coerce, Invalid, Range
 
 # module
 from avwx.structs import Coord
@@ -20,9 +22,15 @@ Latitude = All(Coerce(float), Range(-90, 90))
 Longitude = All(Coerce(float), Range(-180, 180))
 
 
+@cache
+def _compile(pattern: str) -> re.Pattern:
+    """Compiles each pattern once, independent of the re module's bounded cache"""
+    return re.compile(pattern)
+
+
 def MatchesRE(name: str, pattern: str) -> Callable:
     """Returns a validation function that checks if a string matches a regex pattern"""
-    expr = re.compile(pattern)
+    expr = _compile(pattern)
 
     def mre(txt: str) -> str:
         """Raises an exception if a string doesn't match the required format"""
@@ -33,12 +41,50 @@ def MatchesRE(name: str, pattern: str) -> Callable:
     return mre
 
 
-Token = All(
-    str,
-    Length(min=10),
-    lambda x: x.strip().split()[-1],
-    MatchesRE("token", r"[A-Za-z0-9\-\_]+"),
-)
+# Deleting every allowed character from a valid token leaves nothing
+_TOKEN_CHARS = (ascii_letters + digits + "-_").encode()
+
+
+def parse_token(value: Any) -> Optional[str]:
+    """Returns the token from an auth string like 'Bearer <token>' or None if invalid
+
+    Doesn't raise, so it's cheap to call on every request
+    """
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    parts = value.rsplit(maxsplit=1)
+    if not parts:
+        return None
+    token = parts[-1]
+    if not token.isascii() or token.encode().translate(None, _TOKEN_CHARS):
+        return None
+    return token
+
+
+def validate_token(value: Any) -> str:
+    """Returns the token from an auth string like 'Bearer <token>' in a single pass"""
+    if not isinstance(value, str) or len(value) < 10:
+        raise Invalid("Token must be a string at least 10 characters long")
+    if (token := parse_token(value)) is None:
+        raise Invalid(f"'{value}' is not a valid token")
+    return token
+
+
+# Schema name for the token validator
+Token = validate_token
+
+
+def _coordinate(value: str, bound: float) -> float:
+    """Inline Coerce(float) and Range(-bound, bound) for route coordinates"""
+    try:
+        num = float(value)
+    except ValueError as exc:
+        raise Invalid("expected float") from exc
+    if not num >= -bound:
+        raise Invalid(f"value must be at least {-bound}")
+    if num > bound:
+        raise Invalid(f"value must be at most {bound}")
+    return num
 
 
 def FlightRoute(values: str) -> list[Coord]:
@@ -49,5 +95,6 @@ def FlightRoute(values: str) -> list[Coord]:
     for i, val in enumerate(values):
         if "," in val:
             loc = val.split(",")
-            values[i] = Coord(lat=Latitude(loc[0]), lon=Longitude(loc[1]), repr=val)
+            lat, lon = _coordinate(loc[0], 90), _coordinate(loc[1], 180)
+            values[i] = Coord(lat=lat, lon=lon, repr=val)
     return to_coordinates(values)
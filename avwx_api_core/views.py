@@ -2,23 +2,43 @@
 Core API view handlers
 """
 
-# pylint: disable=too-many-arguments
+# pylint: disable=too-many-arguments,unidiomatic-typecheck
 
 # stdlib
+from collections import OrderedDict
 from datetime import datetime, timezone
 from functools import wraps
-from typing import Callable, Optional
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Optional,
+)
 
 # library
 import yaml
-from dicttoxml import dicttoxml as fxml
-from quart import Quart, Response, jsonify, request
+from quart import Quart, Response, current_app, request
 from quart_openapi import Resource
-from voluptuous import Invalid, MultipleInvalid
+
+try:
+    from yaml import CSafeDumper as YAMLDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeDumper as YAMLDumper
 
 # module
 from avwx_api_core import validate
+from avwx_api_core.app import dump_json
 from avwx_api_core.token import Token, TokenManager
+from avwx_api_core.util.dictxml import to_xml
+
+
+# Exact types walked by format_output. Responses never contain subclasses
+_CONTAINERS = (dict, list)
+
+# Query parameter values that turn on a flag
+_TRUE = frozenset(("1", "true", "yes"))
 
 
 class BaseView(Resource):
@@ -30,6 +50,8 @@ class BaseView(Resource):
     key_repl: dict = None
     # Remove the following keys from the final response
     key_remv: list[str] = None
+    # Also remove these keys when the request has the "light" parameter
+    key_remv_light: list[str] = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -37,23 +59,48 @@ class BaseView(Resource):
             self.key_repl = {}
         if self.key_remv is None:
             self.key_remv = []
+        if self.key_remv_light is None:
+            self.key_remv_light = []
 
-    def format_output(self, output: dict) -> dict:
-        """Formats a dict by recursively replacing or removing keys"""
-        if isinstance(output, list):
-            return [self.format_output(item) for item in output]
-        if not isinstance(output, dict):
+    def _response_remv(self) -> Optional[frozenset[str]]:
+        """Returns the light removals if this view has them and they're requested"""
+        if self.key_remv_light and request.args.get("light", "").lower() in _TRUE:
+            return frozenset((*self.key_remv, *self.key_remv_light))
+        return None
+
+    def format_output(self, output: dict, remv: Iterable[str] = None) -> dict:
+        """Formats a dict by replacing or removing keys in all nested dicts
+
+        remv overrides the view's key_remv, like for light responses
+
+        Returns a new structure or the original output if there's nothing to change
+        Nested values are only formatted if they are plain dicts or lists
+        """
+        repl = self.key_repl
+        if remv is None:
+            remv = self.key_remv
+        # Key changes can be set per instance, so check the current values
+        if not (repl or remv) or not isinstance(output, (dict, list)):
             return output
-        resp = {}
-        for key, val in output.items():
-            if key in self.key_remv:
-                continue
-            if key in self.key_repl:
-                key = self.key_repl[key]
-            if isinstance(val, (dict, list)):
-                val = self.format_output(val)
-            resp[key] = val
-        return resp
+        if type(remv) not in (set, frozenset):
+            remv = frozenset(remv)
+        root = [None]
+        # Each new container is built then set in its parent at the same position
+        stack = [(root, 0, output)]
+        while stack:
+            parent, index, value = stack.pop()
+            if type(value) is list:
+                new = list(value)
+                for i, item in enumerate(value):
+                    if type(item) in _CONTAINERS:
+                        stack.append((new, i, item))
+            else:
+                new = {repl.get(k, k): v for k, v in value.items() if k not in remv}
+                for key, val in new.items():
+                    if type(val) in _CONTAINERS:
+                        stack.append((new, key, val))
+            parent[index] = new
+        return root[0]
 
     def make_response(
         self,
@@ -65,25 +112,75 @@ class BaseView(Resource):
         root: str = "AVWX",
     ) -> Response:
         """Returns the output string based on format param"""
-        output = self.format_output(output)
+        output = self.format_output(output, self._response_remv())
+        # format_output may return the caller's data unchanged, so copy on write
         if "error" in output and meta not in output:
-            output["timestamp"] = datetime.now(tz=timezone.utc)
+            # Formatted here so every serializer gets the same plain string
+            now = datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z")
+            output = {**output, "timestamp": now}
         if self.note and isinstance(output, dict):
-            if meta not in output:
-                output[meta] = {}
-            output[meta]["note"] = self.note
+            output = {**output, meta: {**output.get(meta, {}), "note": self.note}}
         if format == "xml":
-            resp = Response(fxml(output, custom_root=root.upper()), mimetype="text/xml")
+            resp = Response(to_xml(output, root.upper()), mimetype="text/xml")
         elif format == "yaml":
             resp = Response(
-                yaml.dump(output, default_flow_style=False), mimetype="text/x-yaml"
+                yaml.dump(output, Dumper=YAMLDumper, default_flow_style=False),
+                mimetype="text/x-yaml",
             )
         else:
-            resp = jsonify(output)
+            # Same output as jsonify without the str round trip
+            config = current_app.config
+            indent = config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug
+            body = dump_json(output, config["JSON_SORT_KEYS"], indent)
+            resp = Response(body, content_type=config["JSONIFY_MIMETYPE"])
         resp.status_code = code
-        resp.headers["X-Robots-Tag"] = "noindex"
         return resp
 
+    def make_streaming_response(
+        self,
+        items: Iterable | AsyncIterable,
+        meta: dict = None,
+        key: str = "data",
+        code: int = 200,
+        meta_key: str = "meta",
+    ) -> Response:
+        """Returns a JSON response that serializes list items as they are sent
+
+        For long lists where the full body shouldn't be built in memory first.
+        The body is an object with meta and the formatted items under key
+        """
+        config = current_app.config
+        sort_keys = config["JSON_SORT_KEYS"]
+        remv = self._response_remv()
+        meta = self.format_output(meta or {}, remv)
+        if self.note:
+            meta = {**meta, "note": self.note}
+        meta_part = dump_json(meta_key) + b":" + dump_json(meta, sort_keys)
+        meta_first = not sort_keys or meta_key < key
+
+        async def body():
+            yield b"{" + meta_part + b"," if meta_first else b"{"
+            yield dump_json(key) + b":["
+            sep = b""
+            async for item in _aiter(items):
+                yield sep + dump_json(self.format_output(item, remv), sort_keys)
+                sep = b","
+            yield b"]}" if meta_first else b"]," + meta_part + b"}"
+
+        resp = Response(body(), content_type=config["JSONIFY_MIMETYPE"])
+        resp.status_code = code
+        return resp
+
+
+async def _aiter(items: Iterable | AsyncIterable) -> AsyncIterator:
+    """Iterate over sync or async items"""
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
 
 def make_token_check(app: Quart) -> Callable:
     """Pass the core app to allow access to the token manager"""
@@ -121,6 +218,30 @@ VALIDATION_ERROR_MESSAGES = {
 }
 
 
+_TOKEN_REASONS = {
+    None: "",
+    "missing": ". Token value could not be found",
+    "inactive": ". Token marked as inactive",
+}
+_EXAMPLE_NOTE = ". Here's an example response for testing purposes"
+
+# Final messages by error code, token reason, and if an example is included
+_MESSAGES = {
+    (code, reason, example): msg + suffix + (_EXAMPLE_NOTE if example else "")
+    for code, msg in VALIDATION_ERROR_MESSAGES.items()
+    for reason, suffix in _TOKEN_REASONS.items()
+    for example in (False, True)
+}
+
+# Wrong plan messages by view class, token plan type, and if an example is included
+_PLAN_MESSAGES: dict[tuple[type, str, bool], str] = {}
+
+# Loaded example payloads by view class and report type. Never mutate these
+# Report types come from unvalidated requests, so only the most recent are kept
+_EXAMPLES: OrderedDict[tuple[type, str], Any] = OrderedDict()
+_EXAMPLES_LIMIT = 256
+
+
 class AuthView(BaseView):
     """Views requiring token authentication"""
 
@@ -134,11 +255,8 @@ class AuthView(BaseView):
     @staticmethod
     def _auth_token() -> Optional[str]:
         """Extracts the supplied API token from the request"""
-        return (
-            request.headers.get("AUTHORIZATION")
-            or request.headers.get("Authorization")
-            or request.args.get("token")
-        )
+        # Header lookups are case-insensitive
+        return request.headers.get("Authorization") or request.args.get("token")
 
     async def validate_token(self, token_manager: TokenManager) -> tuple[int, Token]:
         """Validates thats an authorization token exists and is active
@@ -147,9 +265,8 @@ class AuthView(BaseView):
         """
         if not token_manager.active:
             return 200, None
-        try:
-            auth_token = validate.Token(self._auth_token())
-        except (Invalid, MultipleInvalid):
+        auth_token = validate.parse_token(self._auth_token())
+        if auth_token is None:
             return 401, None
         auth_token = await token_manager.get(auth_token)
         if auth_token is None or not auth_token.active:
@@ -176,21 +293,43 @@ class AuthView(BaseView):
         self, error_code: int, report_type: str, token: Token
     ) -> dict:
         """Returns an example payload when validation fails"""
-        data = self.get_example_file(report_type)
-        msg = VALIDATION_ERROR_MESSAGES[error_code]
+        key = (type(self), report_type)
+        if key in _EXAMPLES:
+            data = _EXAMPLES[key]
+            _EXAMPLES.move_to_end(key)
+        else:
+            data = _EXAMPLES[key] = self.get_example_file(report_type)
+            if len(_EXAMPLES) > _EXAMPLES_LIMIT:
+                _EXAMPLES.popitem(last=False)
+        example, reason = bool(data), None
         # Special handling for 403 errors
         if error_code == 403:
             if token is None:
-                msg += ". Token value could not be found"
+                reason = "missing"
             elif not token.active:
-                msg += ". Token marked as inactive"
+                reason = "inactive"
             elif not token.valid_type(self.plan_types):
-                allowed = "/".join(self.plan_types or [])
-                msg += f'. Plan "{token.type}" must be {allowed}'
-        if data:
-            msg += ". Here's an example response for testing purposes"
+                return self._with_message(data, self._plan_message(token, example))
+        return self._with_message(data, _MESSAGES[(error_code, reason, example)])
+
+    def _plan_message(self, token: Token, example: bool) -> str:
+        """Returns the 403 message for a token plan not allowed by this view"""
+        key = (type(self), token.type, example)
+        if (msg := _PLAN_MESSAGES.get(key)) is None:
+            allowed = "/".join(self.plan_types or [])
+            msg = VALIDATION_ERROR_MESSAGES[403]
+            msg += f'. Plan "{token.type}" must be {allowed}'
+            if example:
+                msg += _EXAMPLE_NOTE
+            _PLAN_MESSAGES[key] = msg
+        return msg
+
+    @staticmethod
+    def _with_message(data: Any, msg: str) -> Any:
+        """Adds the validation message to a copy of the example payload"""
+        # Shallow copies keep the cached example unchanged
         if isinstance(data, dict):
-            data["meta"] = {"validation_error": msg}
+            data = {**data, "meta": {"validation_error": msg}}
         elif isinstance(data, list):
-            data.insert(0, {"validation_error": msg})  # pylint: disable=no-member
+            data = [{"validation_error": msg}, *data]
         return data
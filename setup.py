@@ -18,10 +18,10 @@ setup(
     ],
     python_requires=">= 3.10",
     install_requires=[
-        "dicttoxml @ git+https://github.com/avwx-rest/dicttoxml",
         "avwx-engine>=1.7",
         "dnspython~=2.2",
         "motor~=2.5",
+        "orjson~=3.8",
         "pyyaml~=6.0",
         "quart~=0.17",
         "quart-openapi>=1.7.1",
@@ -0,0 +1,51 @@
+"""
+Cache document processing tests
+"""
+
+# stdlib
+from datetime import datetime, timezone
+
+# module
+from avwx_api_core.cache import ESCAPED_FLAG, _process_data, _restore_data
+
+NOW = datetime(2022, 1, 2, 3, 4, tzinfo=timezone.utc)
+
+PROCESSED = (
+    ({"a": 1}, {"a": 1, ESCAPED_FLAG: 0, "timestamp": NOW}),
+    (
+        {"$": 1, "a": [{"$": 2}]},
+        {"_$": 1, "a": [{"_$": 2}], ESCAPED_FLAG: 1, "timestamp": NOW},
+    ),
+)
+
+RESTORED = (
+    # Clean and escaped writes
+    ({"a": {"_$": 1}, ESCAPED_FLAG: 0}, {"a": {"_$": 1}}),
+    ({"a": {"_$": 1}, ESCAPED_FLAG: 1}, {"a": {"$": 1}}),
+    # Written before the flag existed
+    ({"a": [{"_$": 1}]}, {"a": [{"$": 1}]}),
+    # Escaped field kept by $set from an earlier write
+    ({"_$": 1, "a": 2, "b": 3, ESCAPED_FLAG: 0}, {"$": 1, "a": 2, "b": 3}),
+    (None, None),
+)
+
+
+def test_process_data():
+    """Test '$' keys are escaped and flagged without changing the input"""
+    for data, target in PROCESSED:
+        original = repr(data)
+        assert _process_data(data, NOW) == target
+        assert repr(data) == original
+
+
+def test_restore_data():
+    """Test escaped keys are restored and the flag is removed"""
+    for data, target in RESTORED:
+        assert _restore_data(data) == target
+
+
+def test_round_trip():
+    """Test a merged clean write over an escaped one still restores keys"""
+    stored = _process_data({"$": 1, "a": 2}, NOW)
+    stored.update(_process_data({"b": 3}, NOW))
+    assert _restore_data(stored) == {"$": 1, "a": 2, "b": 3, "timestamp": NOW}
@@ -0,0 +1,66 @@
+"""
+XML conversion tests
+"""
+
+# stdlib
+from datetime import date, datetime, timezone
+
+# library
+import pytest
+
+# module
+from avwx_api_core.util.dictxml import to_xml
+
+HEADER = '<?xml version="1.0" encoding="UTF-8" ?>'
+
+XML_OUTPUT = (
+    (
+        {"a": None, "b": True, "c": [True, False, None], "d": 1.5, "e": "x<&>"},
+        '<a type="null"></a><b type="bool">true</b><c type="list">'
+        '<item type="bool">True</item><item type="bool">False</item>'
+        '<item type="null"></item></c><d type="float">1.5</d>'
+        '<e type="str">x&lt;&amp;&gt;</e>',
+    ),
+    (
+        {"1": 1, "2.5": 2, "has space": "s", "bad<key": "v", "$": "d"},
+        '<n1 type="int">1</n1><n2.5 type="int">2</n2.5>'
+        '<has_space type="str">s</has_space>'
+        '<key name="bad&lt;key" type="str">v</key><key name="$" type="str">d</key>',
+    ),
+    (
+        {
+            "time": datetime(2022, 1, 2, 3, 4, tzinfo=timezone.utc),
+            "day": date(2022, 1, 2),
+            "items": [date(2022, 1, 2)],
+        },
+        '<time type="str">2022-01-02T03:04:00+00:00</time>'
+        '<day type="str">2022-01-02</day>'
+        '<items type="list"><item type="str">2022-01-02</item></items>',
+    ),
+    (
+        {"nested": {"list": [[1, "a"], {"k": None}]}},
+        '<nested type="dict"><list type="list"><item type="list">'
+        '<item type="int">1</item><item type="str">a</item></item>'
+        '<item type="dict"><k type="null"></k></item></list></nested>',
+    ),
+    (
+        [1, "two", {"three": 3}],
+        '<item type="int">1</item><item type="str">two</item>'
+        '<item type="dict"><three type="int">3</three></item>',
+    ),
+    (None, '<item type="null"></item>'),
+    (True, '<item type="bool">true</item>'),
+    ("text", '<item type="str">text</item>'),
+)
+
+
+def test_to_xml():
+    """Test XML output for values, keys, and nesting matches dicttoxml"""
+    for data, target in XML_OUTPUT:
+        assert to_xml(data, "AVWX") == f"{HEADER}<AVWX>{target}</AVWX>".encode()
+
+
+def test_to_xml_unsupported():
+    """Test that unknown value types raise"""
+    with pytest.raises(TypeError):
+        to_xml({"a": object()})
@@ -0,0 +1,59 @@
+"""
+Task queue tests
+"""
+
+# stdlib
+import asyncio as aio
+
+# library
+import pytest
+
+# module
+from avwx_api_core.util.queue import Queue
+
+
+class ShardWorker:
+    """Collects batches by the shard they came from"""
+
+    def __init__(self):
+        self.batches = []
+
+    async def _worker(self, shard: int):
+        while True:
+            async with self._queue.get_batch(shard, 3) as values:
+                self.batches.append((shard, values))
+
+
+class LegacyWorker:
+    """Takes values one at a time from any shard"""
+
+    def __init__(self):
+        self.values = []
+
+    async def _worker(self):
+        while True:
+            async with self._queue.get() as value:
+                self.values.append(value)
+
+
+@pytest.mark.asyncio
+async def test_keyed_batches():
+    """Test values with the same key are batched on one shard"""
+    worker = ShardWorker()
+    worker._queue = queue = Queue(worker)
+    for i in range(5):
+        queue.add(i, "user")
+    await aio.wait_for(queue.clean(), 1)
+    assert len({shard for shard, _ in worker.batches}) == 1
+    assert [values for _, values in worker.batches] == [[0, 1, 2], [3, 4]]
+
+
+@pytest.mark.asyncio
+async def test_legacy_worker():
+    """Test workers without a shard argument drain every shard"""
+    worker = LegacyWorker()
+    worker._queue = queue = Queue(worker)
+    for i in range(10):
+        queue.add(i)
+    await aio.wait_for(queue.clean(), 1)
+    assert sorted(worker.values) == list(range(10))
@@ -0,0 +1,189 @@
+"""
+Token counter tests using a stub Mongo database
+"""
+
+# stdlib
+import asyncio as aio
+from copy import deepcopy
+from types import SimpleNamespace
+
+# library
+import pytest
+from bson.objectid import ObjectId
+from quart import Quart
+
+# module
+from avwx_api_core.counter.token import DEV_TOKEN_LIMIT, TokenCountCache
+
+USER_A, USER_B, USER_C = ObjectId(), ObjectId(), ObjectId()
+TOKEN_IDS = {
+    value: ObjectId() for value in ("token-a1", "token-a2", "dev-a1", "token-b1")
+}
+
+USERS = (
+    {
+        "_id": USER_A,
+        "tokens": [
+            {"_id": TOKEN_IDS[v], "value": v, "active": True}
+            for v in ("token-a1", "token-a2", "dev-a1")
+        ],
+        "plan": {"limit": 3, "name": "Basic", "type": "basic"},
+    },
+    {
+        "_id": USER_B,
+        "tokens": [{"_id": TOKEN_IDS["token-b1"], "value": "token-b1", "active": True}],
+        "plan": {"limit": 2, "name": "Pro", "type": "pro"},
+        "allow_overage": True,
+    },
+    # Legacy token without an _id
+    {
+        "_id": USER_C,
+        "tokens": [{"value": "token-c1", "active": True}],
+        "plan": {"limit": None, "name": "Enterprise", "type": "enterprise"},
+    },
+)
+
+# Tokens added in order and if each call is allowed. Token a1 starts with 1 call
+ADD_RESULTS = (
+    (("token-a1", "token-a2", "token-a1"), (True, True, False)),
+    (("dev-a1", "token-a1", "dev-a1"), (True, True, True)),
+    (("token-b1", "token-b1", "token-b1"), (True, True, True)),
+    (("missing",), (False,)),
+)
+
+
+class StubCursor:
+    """Aggregation result with the Motor to_list interface"""
+
+    def __init__(self, data: list[dict]):
+        self.data = data
+
+    async def to_list(self, length: int = None) -> list[dict]:
+        """Returns the aggregation result"""
+        return self.data
+
+
+class StubMongo:
+    """Stands in for the account user and token collections"""
+
+    def __init__(self):
+        self.queries = []
+        self.usage = {TOKEN_IDS["token-a1"]: 1}
+        self.user = SimpleNamespace(aggregate=self.aggregate)
+        self.token = SimpleNamespace(bulk_write=self.bulk_write)
+        self.account = self
+
+    def aggregate(self, pipeline: list[dict]) -> StubCursor:
+        """Returns users with any matching token and their token usage"""
+        tokens = pipeline[0]["$match"]["tokens.value"]["$in"]
+        self.queries.append(tokens)
+        users = []
+        for user in USERS:
+            if any(item["value"] in tokens for item in user["tokens"]):
+                user = deepcopy(user)
+                user["usage"] = [
+                    {"_id": item.get("_id"), "total": self.usage.get(item.get("_id"))}
+                    for item in user["tokens"]
+                    if item.get("_id") in self.usage
+                ]
+                users.append(user)
+        return StubCursor(users)
+
+    async def bulk_write(self, updates: list) -> None:
+        """Applies count increments after a delay like a remote write"""
+        await aio.sleep(0.01)
+        for update in updates:
+            # pylint: disable=protected-access
+            if inc := update._doc.get("$inc"):
+                token_id = update._filter["token_id"]
+                self.usage[token_id] = self.usage.get(token_id, 0) + inc["count"]
+
+
+def make_counter() -> tuple[TokenCountCache, StubMongo]:
+    """Returns a token counter using a new stub database"""
+    app = Quart(__name__)
+    app.mdb = StubMongo()
+    counter = TokenCountCache(app)
+    counter.prefetch_limit = 0
+    return counter, app.mdb
+
+
+@pytest.mark.asyncio
+async def test_batched_lookup():
+    """Test concurrent lookups are sent as one query"""
+    counter, mdb = make_counter()
+    tokens = ("token-a1", "token-a2", "token-b1", "missing")
+    data = await aio.gather(*(counter.get(token) for token in tokens))
+    assert len(mdb.queries) == 1
+    assert sorted(mdb.queries[0]) == sorted(tokens)
+    assert [item["user"] for item in data[:3]] == [USER_A, USER_A, USER_B]
+    assert data[3] is None
+    # Cached tokens are not fetched again
+    await counter.get("token-a2")
+    assert len(mdb.queries) == 1
+    await counter.clean()
+
+
+@pytest.mark.asyncio
+async def test_lookup_error():
+    """Test a malformed user only fails its own lookup"""
+    counter, mdb = make_counter()
+    bad, good = await aio.gather(
+        counter.get("token-c1"), counter.get("token-b1"), return_exceptions=True
+    )
+    assert len(mdb.queries) == 1
+    assert isinstance(bad, KeyError)
+    assert good["user"] == USER_B
+    await counter.clean()
+
+
+@pytest.mark.asyncio
+async def test_add():
+    """Test limits against shared user totals kept separately for dev tokens"""
+    for tokens, results in ADD_RESULTS:
+        counter, _ = make_counter()
+        for token, allowed in zip(tokens, results):
+            await counter.get(token)
+            assert await counter.add(token) is allowed
+        await counter.clean()
+
+
+@pytest.mark.asyncio
+async def test_totals():
+    """Test dev and regular tokens count against separate totals"""
+    counter, _ = make_counter()
+    for token in ("token-a1", "token-a2", "dev-a1"):
+        await counter.get(token)
+        await counter.add(token)
+    # pylint: disable=protected-access
+    assert counter._user == {(USER_A, False): 3, (USER_A, True): 1}
+    assert (await counter.get("dev-a1"))["limit"] == DEV_TOKEN_LIMIT
+    await counter.clean()
+
+
+@pytest.mark.asyncio
+async def test_overage():
+    """Test calls over the limit are counted as overage when allowed"""
+    counter, mdb = make_counter()
+    await counter.get("token-b1")
+    for _ in range(3):
+        assert await counter.add("token-b1")
+    # pylint: disable=protected-access
+    assert counter._data["token-b1"].overage == 1
+    await counter.clean()
+    assert mdb.usage[TOKEN_IDS["token-b1"]] == 3
+
+
+@pytest.mark.asyncio
+async def test_prefetch_after_write():
+    """Test prefetched totals include the counts written by the update"""
+    counter, mdb = make_counter()
+    counter.prefetch_limit = 10
+    await counter.get("token-a1")
+    await counter.add("token-a1")
+    counter.update()
+    # pylint: disable=protected-access
+    await aio.gather(*counter._prefetch_tasks)
+    assert len(mdb.queries) == 2
+    assert counter._user[(USER_A, False)] == 2
+    await counter.clean()
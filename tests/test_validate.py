@@ -0,0 +1,43 @@
+"""
+Schema validation tests
+"""
+
+# library
+import pytest
+from voluptuous import Invalid
+
+# module
+from avwx_api_core import validate
+
+TOKENS = (
+    ("abcdefghij", "abcdefghij"),
+    ("Bearer abc-DEF_123", "abc-DEF_123"),
+    ("Token  abc-DEF_123  ", "abc-DEF_123"),
+    ("Bearer a b c d e f", "f"),
+)
+
+BAD_TOKENS = (
+    None,
+    12345678901,
+    "",
+    "short",
+    " " * 12,
+    "\t\n" * 6,
+    "Bearer abc.def/123",
+    "Bearer abcdéfghij",
+)
+
+
+def test_parse_token():
+    """Test token extraction from auth strings"""
+    for value, target in TOKENS:
+        assert validate.parse_token(value) == target
+        assert validate.validate_token(value) == target
+
+
+def test_parse_token_invalid():
+    """Test invalid auth strings return None or raise when validating"""
+    for value in BAD_TOKENS:
+        assert validate.parse_token(value) is None
+        with pytest.raises(Invalid):
+            validate.validate_token(value)
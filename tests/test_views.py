@@ -0,0 +1,72 @@
+"""
+View output formatting tests
+"""
+
+# module
+from avwx_api_core.views import BaseView
+
+
+class KeyView(BaseView):
+    """View that replaces and removes keys"""
+
+    key_repl = {"old": "new"}
+    key_remv = {"drop"}
+    key_remv_light = {"heavy"}
+
+
+OUTPUT = {
+    "old": 1,
+    "drop": 2,
+    "heavy": 3,
+    "items": [
+        {"old": [{"drop": 4, "old": 5}], "heavy": {"old": 6}},
+        [{"drop": 7}, "old", None],
+    ],
+}
+
+
+def test_format_output():
+    """Test key replace and remove in nested dicts and lists"""
+    output = KeyView().format_output(OUTPUT)
+    assert output == {
+        "new": 1,
+        "heavy": 3,
+        "items": [
+            {"new": [{"new": 5}], "heavy": {"new": 6}},
+            [{}, "old", None],
+        ],
+    }
+    # The original output is not modified
+    assert OUTPUT["items"][0]["old"][0] == {"drop": 4, "old": 5}
+
+
+def test_format_output_light():
+    """Test light removals are applied with the view's own"""
+    output = KeyView().format_output(OUTPUT, {"drop", "heavy"})
+    assert output == {
+        "new": 1,
+        "items": [{"new": [{"new": 5}]}, [{}, "old", None]],
+    }
+
+
+def test_format_output_unchanged():
+    """Test views without key changes return the same output"""
+    assert BaseView().format_output(OUTPUT) is OUTPUT
+    assert KeyView().format_output("text") == "text"
+
+
+class InstanceView(BaseView):
+    """View that sets key changes per instance"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_repl = {"old": "new"}
+        self.key_remv.append("drop")
+
+
+def test_format_output_instance():
+    """Test key changes set on the instance are applied"""
+    output = InstanceView().format_output({"old": 1, "drop": 2})
+    assert output == {"new": 1}
+    # Instances don't share their key lists
+    assert not BaseView().key_remv
@@ -2,6 +2,7 @@
 Build navaid coordinate map
 """
 
+import csv
 import json
 from pathlib import Path
 import httpx
@@ -14,22 +15,18 @@ FILE_PATH = Path(__file__).parent.parent.joinpath(
 
 def main():
     """Build navaid coordinate map"""
-    text = httpx.get(URL).text
-    lines = text.strip().split("\n")
-    lines.pop(0)
     data = {}
-    for line in lines:
-        line = line.split(",")
-        try:
-            ident, lat, lon = line[2].strip('"'), float(line[6]), float(line[7])
-        except ValueError:
-            continue
-        if not ident:
-            continue
-        try:
-            data[ident].add((lat, lon))
-        except KeyError:
-            data[ident] = {(lat, lon)}
+    with httpx.stream("GET", URL) as resp:
+        # Quoted fields like navaid names can contain commas
+        reader = csv.reader(resp.iter_lines())
+        next(reader)
+        for row in reader:
+            try:
+                ident, lat, lon = row[2], float(row[6]), float(row[7])
+            except (IndexError, ValueError):
+                continue
+            if ident:
+                data.setdefault(ident, set()).add((lat, lon))
     data = {k: list(v) for k, v in data.items()}
     json.dump(data, FILE_PATH.open("w"), indent=2, sort_keys=True)
 
@@ -4,15 +4,22 @@ Updates instances where user tokens have no ID
 
 from os import environ
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
 DB = MongoClient(environ["MONGO_URI"])
+BATCH_SIZE = 1000
 
 query = {"$and": [{"tokens._id": {"$exists": False}}, {"tokens.value": {"$exists": True}}]}
+updates = []
 for user in DB.account.user.find(query, {"tokens": 1}):
     uid, tokens = user["_id"], user["tokens"]
     print(uid)
     for i, token in enumerate(tokens):
         if "_id" not in token:
             tokens[i]["_id"] = str(ObjectId())
-    DB.account.user.update_one({"_id": uid}, {"$set": {"tokens": tokens}})
+    updates.append(UpdateOne({"_id": uid}, {"$set": {"tokens": tokens}}))
+    if len(updates) >= BATCH_SIZE:
+        DB.account.user.bulk_write(updates, ordered=False)
+        updates = []
+if updates:
+    DB.account.user.bulk_write(updates, ordered=False)